@@ -1,10 +1,13 @@
 import requests
+import orjson
 import time
-import math
 import threading
 import random
+import bisect
 import logging
-from collections import deque
+import queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import os
@@ -32,6 +35,12 @@ BASE_URL = "https://www.deribit.com/api/v2"
 
 CURRENCIES = ["BTC", "ETH"]
 
+FETCH_WORKERS = 8
+
+# Deribit public limit is ~20 req/s sustained per IP; stay well under it
+DERIBIT_RATE_PER_SEC = 10
+DERIBIT_BURST = 20
+
 degraded_cycles = {s: 0 for s in CURRENCIES}
 degraded_alert_sent = {s: False for s in CURRENCIES}
 
@@ -39,6 +48,9 @@ CHECK_INTERVAL = 600  # 10 min
 
 EVENT_NAME = "deribit_vbi_snapshot"
 
+OPTIONS_CACHE_TTL_MS = 3600_000  # 1 h, instruments change only at listings
+BOOK_MISS_TTL_MS = 3 * CHECK_INTERVAL * 1000  # skip a missing book for 3 cycles
+
 # --- VBI params ---
 IV_SLOPE_STRONG = 6.0
 IV_SLOPE_MEDIUM = 3.0
@@ -59,30 +71,39 @@ FAR_DTE_RANGE  = (45, 120)
 def now_ts_ms():
     return int(time.time() * 1000)
 
-def now_iso_utc():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+def iso_utc(ts_ms):
+    return datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-def dte_days(exp_ts):
-    return (exp_ts - now_ts_ms()) / (1000 * 60 * 60 * 24)
+def dte_days(exp_ts, now_ms):
+    return (exp_ts - now_ms) / (1000 * 60 * 60 * 24)
 
 # ===================== SUPABASE =====================
 
-def _sanitize_for_json(value):
-    if isinstance(value, float):
-        return value if math.isfinite(value) else None
-    if isinstance(value, dict):
-        return {k: _sanitize_for_json(v) for k, v in value.items()}
-    if isinstance(value, (list, tuple)):
-        return [_sanitize_for_json(v) for v in value]
-    return value
-
-def send_to_db(event, payload):
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        return
+supabase_session = requests.Session()
+
+_db_queue = queue.Queue(maxsize=1024)
 
+# heartbeat rows differ only in ts; splice it into pre-serialized bytes
+HEARTBEAT_ROW = (
+    b'{"ts":%d,"event":"deribit_vbi_heartbeat","symbol":"SYSTEM",'
+    b'"data":{"ts_unix_ms":%d,"symbol":"SYSTEM","status":"alive"}}'
+)
+
+def encode_row(event, payload):
+    # orjson writes non-finite floats as null
+    return orjson.dumps({
+        "ts": payload["ts_unix_ms"],
+        "event": event,
+        "symbol": payload["symbol"],
+        "data": payload
+    })
+
+def heartbeat_row(ts_ms):
+    return HEARTBEAT_ROW % (ts_ms, ts_ms)
+
+def _do_post(body):
     try:
-        safe_payload = _sanitize_for_json(payload)
-        r = requests.post(
+        r = supabase_session.post(
             f"{SUPABASE_URL}/rest/v1/logs",
             headers={
                 "apikey": SUPABASE_KEY,
@@ -90,18 +111,33 @@ def send_to_db(event, payload):
                 "Content-Type": "application/json",
                 "Prefer": "return=minimal"
             },
-            json={
-                "ts": safe_payload["ts_unix_ms"],
-                "event": event,
-                "symbol": safe_payload["symbol"],
-                "data": safe_payload
-            },
+            data=body,
             timeout=5
         )
         r.raise_for_status()
     except Exception:
         return
 
+def _db_worker():
+    while True:
+        rows = _db_queue.get()
+        # one cycle per POST: PostgREST inserts a JSON array all-or-nothing
+        _do_post(b"[" + b",".join(rows) + b"]")
+
+def send_to_db(rows):
+    if not SUPABASE_URL or not SUPABASE_KEY or not rows:
+        return
+
+    while True:
+        try:
+            _db_queue.put_nowait(rows)
+            return
+        except queue.Full:
+            try:
+                _db_queue.get_nowait()
+            except queue.Empty:
+                pass
+
 # ===================== HTTP (HEALTH) =====================
 
 class HealthHandler(BaseHTTPRequestHandler):
@@ -126,14 +162,42 @@ def run_http_server():
 
 session = requests.Session()
 
-def get_json(method, params=None, retries=3):
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(DERIBIT_RATE_PER_SEC, DERIBIT_BURST)
+
+executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+def get_json(method, params=None, retries=3, timeout=15):
     url = f"{BASE_URL}/{method}"
 
     for attempt in range(retries):
         try:
-            r = session.get(url, params=params, timeout=15)
+            rate_limiter.acquire()
+            r = session.get(url, params=params, timeout=timeout)
             r.raise_for_status()
-            j = r.json()
+            j = orjson.loads(r.content)
             if "error" in j:
                 raise Exception(j["error"])
             return j["result"]
@@ -148,8 +212,14 @@ def get_index_price(currency):
         {"index_name": f"{currency.lower()}_usd"}
     )["index_price"]
 
+_options_cache = {}
+
 def get_options(currency):
-    return get_json(
+    cached = _options_cache.get(currency)
+    if cached and now_ts_ms() - cached[0] < OPTIONS_CACHE_TTL_MS:
+        return cached[1], cached[2]
+
+    options = get_json(
         "public/get_instruments",
         {
             "currency": currency,
@@ -157,59 +227,143 @@ def get_options(currency):
             "expired": "false"
         }
     )
+    by_exp_type = index_options(options)
+    _options_cache[currency] = (now_ts_ms(), options, by_exp_type)
+    return options, by_exp_type
+
+def invalidate_options(currency):
+    _options_cache.pop(currency, None)
 
-def get_book(instr):
-    d = get_json(
-        "public/get_book_summary_by_instrument",
-        {"instrument_name": instr}
+def get_book_summary_by_currency(currency):
+    return get_json(
+        "public/get_book_summary_by_currency",
+        {
+            "currency": currency,
+            "kind": "option"
+        }
     )
-    return d[0] if d else None
 
-# ===================== OPTION HELPERS =====================
+def get_mark_ivs(currency):
+    # only mark_iv is read; drop the other summary fields straight away
+    return {
+        b["instrument_name"]: b.get("mark_iv")
+        for b in get_book_summary_by_currency(currency)
+    }
 
-def pick_rolling_expiries(options):
-    buckets = {"near": [], "mid": [], "far": []}
+_book_misses = {}
 
-    for o in options:
-        dte = dte_days(o["expiration_timestamp"])
-        if NEAR_DTE_RANGE[0] <= dte <= NEAR_DTE_RANGE[1]:
-            buckets["near"].append(o["expiration_timestamp"])
-        elif MID_DTE_RANGE[0] <= dte <= MID_DTE_RANGE[1]:
-            buckets["mid"].append(o["expiration_timestamp"])
-        elif FAR_DTE_RANGE[0] <= dte <= FAR_DTE_RANGE[1]:
-            buckets["far"].append(o["expiration_timestamp"])
-
-    def pick(ts_list, target):
-        if not ts_list:
-            return None
-        mid = sum(target) / 2
-        return min(ts_list, key=lambda ts: abs(dte_days(ts) - mid))
+def get_book(instr, retries=3, timeout=15):
+    now_ms = now_ts_ms()
+    for name, missed_at in list(_book_misses.items()):
+        if now_ms - missed_at >= BOOK_MISS_TTL_MS:
+            _book_misses.pop(name, None)
+    if instr in _book_misses:
+        return None
 
-    return (
-        pick(buckets["near"], NEAR_DTE_RANGE),
-        pick(buckets["mid"],  MID_DTE_RANGE),
-        pick(buckets["far"],  FAR_DTE_RANGE),
-    )
+    try:
+        d = get_json(
+            "public/get_book_summary_by_instrument",
+            {"instrument_name": instr},
+            retries=retries,
+            timeout=timeout
+        )
+    except requests.HTTPError as e:
+        # Deribit rejects unknown/delisted instruments with a 4xx error;
+        # rate limits (429) and server errors are not misses
+        status = e.response.status_code if e.response is not None else None
+        if status is None or status == 429 or not 400 <= status < 500:
+            raise
+        d = None
+
+    if not d:
+        _book_misses[instr] = now_ms
+        return None
+    return d[0]
+
+# ===================== OPTION HELPERS =====================
 
-def atm_option(options, exp, opt_type, spot):
-    cands = [
-        o for o in options
-        if o["expiration_timestamp"] == exp and o["option_type"] == opt_type
-    ]
-    return min(cands, key=lambda o: abs(o["strike"] - spot)) if cands else None
+def pick_rolling_expiries(options, now_ms):
+    ranges = (NEAR_DTE_RANGE, MID_DTE_RANGE, FAR_DTE_RANGE)
+    mids = [sum(r) / 2 for r in ranges]
+    best = [None, None, None]
+    best_dist = [None, None, None]
+
+    # many strikes share an expiry: compute each expiry's DTE once
+    for ts in dict.fromkeys(o["expiration_timestamp"] for o in options):
+        dte = dte_days(ts, now_ms)
+        for i, (lo, hi) in enumerate(ranges):
+            if lo <= dte <= hi:
+                dist = abs(dte - mids[i])
+                if best_dist[i] is None or dist < best_dist[i]:
+                    best[i] = ts
+                    best_dist[i] = dist
+                break
+
+    return tuple(best)
+
+def index_options(options):
+    groups = defaultdict(list)
+    for o in options:
+        groups[(o["expiration_timestamp"], o["option_type"])].append(o)
+
+    by_exp_type = {}
+    for key, opts in groups.items():
+        opts.sort(key=lambda o: o["strike"])
+        by_exp_type[key] = ([o["strike"] for o in opts], opts)
+    return by_exp_type
+
+def atm_option(by_exp_type, exp, opt_type, spot):
+    group = by_exp_type.get((exp, opt_type))
+    if not group:
+        return None
+
+    strikes, opts = group
+    i = bisect.bisect_left(strikes, spot)
+    if i == 0:
+        return opts[0]
+    if i == len(opts):
+        return opts[-1]
+    return opts[i] if strikes[i] - spot < spot - strikes[i - 1] else opts[i - 1]
 
 # ===================== STATE =====================
 
-iv_slope_hist = {s: deque(maxlen=PATTERN_WINDOW) for s in CURRENCIES}
-near_iv_hist  = {s: deque(maxlen=PATTERN_WINDOW) for s in CURRENCIES}
+class RollingWindow:
+    def __init__(self, size):
+        self.buf = [0.0] * size
+        self.idx = 0
+        self.count = 0
+        self.total = 0.0
+
+    def append(self, value):
+        size = len(self.buf)
+        if self.count == size:
+            self.total -= self.buf[self.idx]
+        else:
+            self.count += 1
+        self.buf[self.idx] = value
+        self.idx = (self.idx + 1) % size
+        if self.idx == 0:
+            # resync once per lap so float error cannot accumulate
+            self.total = sum(self.buf)
+        else:
+            self.total += value
+
+    def mean(self):
+        return self.total / self.count
+
+    def __len__(self):
+        return self.count
+
+iv_slope_hist = {s: RollingWindow(PATTERN_WINDOW) for s in CURRENCIES}
+near_iv_hist  = {s: RollingWindow(PATTERN_WINDOW) for s in CURRENCIES}
 
 # ===================== VBI CORE =====================
 
-def degraded(currency, reason):
+def degraded(currency, reason, ts_ms):
     logger.warning(f"{currency}: DEGRADED ({reason})")
     return {
-        "ts_unix_ms": now_ts_ms(),
-        "ts_iso_utc": now_iso_utc(),
+        "ts_unix_ms": ts_ms,
+        "ts_iso_utc": iso_utc(ts_ms),
         "symbol": currency,
         "status": "degraded",
         "reason": reason,
@@ -217,44 +371,64 @@ def degraded(currency, reason):
         "vbi_score": None
     }
 
-def compute_vbi(currency):
+def fetch_market(currency):
+    return (
+        executor.submit(get_options, currency),
+        executor.submit(get_index_price, currency),
+        executor.submit(get_mark_ivs, currency),
+    )
+
+def compute_vbi(currency, market):
+    ts_ms = now_ts_ms()
     try:
-        options = get_options(currency)
-        spot = get_index_price(currency)
+        options_f, spot_f, ivs_f = market
+        options, by_exp_type = options_f.result()
+        spot = spot_f.result()
+        iv_by_instr = ivs_f.result()
 
-        exp1, exp2, exp3 = pick_rolling_expiries(options)
+        exp1, exp2, exp3 = pick_rolling_expiries(options, ts_ms)
         if not exp1 or not exp2 or not exp3:
-            return degraded(currency, "no_expiries")
+            return degraded(currency, "no_expiries", ts_ms)
 
-        n_call = atm_option(options, exp1, "call", spot)
-        n_put  = atm_option(options, exp1, "put", spot)
-        m_call = atm_option(options, exp2, "call", spot)
-        f_call = atm_option(options, exp3, "call", spot)
+        n_call = atm_option(by_exp_type, exp1, "call", spot)
+        n_put  = atm_option(by_exp_type, exp1, "put", spot)
+        m_call = atm_option(by_exp_type, exp2, "call", spot)
+        f_call = atm_option(by_exp_type, exp3, "call", spot)
 
         if not n_call or not n_put or not m_call or not f_call:
-            return degraded(currency, "no_atm")
-
-        nc = get_book(n_call["instrument_name"])
-        np = get_book(n_put["instrument_name"])
-        mc = get_book(m_call["instrument_name"])
-        fc = get_book(f_call["instrument_name"])
+            return degraded(currency, "no_atm", ts_ms)
+
+        names = [o["instrument_name"] for o in (n_call, n_put, m_call, f_call)]
+        missing = [n for n in names if n not in iv_by_instr]
+        if missing:
+            try:
+                books = list(executor.map(
+                    lambda n: get_book(n, retries=1, timeout=3), missing
+                ))
+            except Exception:
+                # the listing named an instrument we cannot look up
+                invalidate_options(currency)
+                raise
+            for n, book in zip(missing, books):
+                if book:
+                    iv_by_instr[n] = book["mark_iv"]
 
-        if not nc or not np or not mc or not fc:
-            return degraded(currency, "no_book")
+        if any(n not in iv_by_instr for n in names):
+            # an ATM instrument with no book anywhere: the listing is stale
+            invalidate_options(currency)
+            return degraded(currency, "no_book", ts_ms)
 
-        near_iv = nc["mark_iv"]
-        mid_iv  = mc["mark_iv"]
-        far_iv  = fc["mark_iv"]
+        near_iv, near_put_iv, mid_iv, far_iv = (iv_by_instr[n] for n in names)
 
         if near_iv is None or mid_iv is None or far_iv is None:
-            return degraded(currency, "no_iv")
+            return degraded(currency, "no_iv", ts_ms)
 
         slope_1 = mid_iv - near_iv
         slope_2 = far_iv - mid_iv
         iv_slope = slope_1
         curvature = slope_2 - slope_1
 
-        skew = np["mark_iv"] / nc["mark_iv"] if nc["mark_iv"] else None
+        skew = near_put_iv / near_iv if near_iv else None
 
         score = 0
         if iv_slope > IV_SLOPE_MEDIUM:
@@ -266,7 +440,7 @@ def compute_vbi(currency):
         near_iv_hist[currency].append(near_iv)
 
         if len(near_iv_hist[currency]) >= PATTERN_WINDOW:
-            if near_iv > sum(near_iv_hist[currency]) / len(near_iv_hist[currency]):
+            if near_iv > near_iv_hist[currency].mean():
                 score += 20
 
         if skew is not None:
@@ -279,8 +453,8 @@ def compute_vbi(currency):
         vbi_state = "COLD" if score < 30 else "WARM" if score <= 60 else "HOT"
 
         return {
-            "ts_unix_ms": now_ts_ms(),
-            "ts_iso_utc": now_iso_utc(),
+            "ts_unix_ms": ts_ms,
+            "ts_iso_utc": iso_utc(ts_ms),
             "symbol": currency,
             "status": "ok",
             "vbi_state": vbi_state,
@@ -293,16 +467,21 @@ def compute_vbi(currency):
             "skew": round(skew, 3) if skew else None
         }
 
+    except KeyError:
+        invalidate_options(currency)
+        return degraded(currency, "exception", ts_ms)
     except Exception:
-        return degraded(currency, "exception")
+        return degraded(currency, "exception", ts_ms)
 
 
+telegram_session = requests.Session()
+
 def send_telegram_alert(text):
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         return
 
     try:
-        requests.post(
+        telegram_session.post(
             f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
             json={
                 "chat_id": TELEGRAM_CHAT_ID,
@@ -317,13 +496,18 @@ def send_telegram_alert(text):
 
 def main():
     threading.Thread(target=run_http_server, daemon=True).start()
+    threading.Thread(target=_db_worker, daemon=True).start()
     logger.info("Starting Deribit VBI service")
 
+    next_tick = time.monotonic()
     while True:
+        rows = []
+        # every currency's Deribit calls go out at once on the shared pool
+        markets = {c: fetch_market(c) for c in CURRENCIES}
         for c in CURRENCIES:
-            out = compute_vbi(c)
+            out = compute_vbi(c, markets[c])
             if out:
-                send_to_db(EVENT_NAME, out)
+                rows.append(encode_row(EVENT_NAME, out))
             
                 if out.get("status") == "degraded":
                     degraded_cycles[c] += 1
@@ -345,16 +529,18 @@ def main():
                     degraded_cycles[c] = 0
                     degraded_alert_sent[c] = False
 
-        send_to_db(
-            "deribit_vbi_heartbeat",
-            {
-                "ts_unix_ms": now_ts_ms(),
-                "symbol": "SYSTEM",
-                "status": "alive"
-            }
-        )
-        logger.info("Heartbeat sent")
-        time.sleep(CHECK_INTERVAL)
+        rows.append(heartbeat_row(now_ts_ms()))
+        send_to_db(rows)
+        logger.info("Heartbeat queued")
+
+        next_tick += CHECK_INTERVAL
+        delay = next_tick - time.monotonic()
+        if delay < 0:
+            skipped = int(-delay // CHECK_INTERVAL) + 1
+            logger.warning(f"Cycle overran by {-delay:.1f}s, skipping {skipped} tick(s)")
+            next_tick += skipped * CHECK_INTERVAL
+            delay = next_tick - time.monotonic()
+        time.sleep(max(0, delay))
 
 if __name__ == "__main__":
     main()